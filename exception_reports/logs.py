@@ -43,7 +43,7 @@ class ExtraDataLogFormatter(logging.Formatter):
     def __init__(self, *args, **kwargs):
         if kwargs.pop("utc_timezone", False):
             self.converter = time.gmtime
-        super(ExtraDataLogFormatter, self).__init__(*args, **kwargs)
+        super().__init__(*args, **kwargs)
 
     def _set_data_as_kv(self, record):
         """Sets 'data_as_kv' attribute as a string of key value pairs."""
@@ -59,7 +59,7 @@ class ExtraDataLogFormatter(logging.Formatter):
     def format(self, record):
         """Add the 'data_as_kv' attribute before formatting message."""
         self._set_data_as_kv(record)
-        return super(ExtraDataLogFormatter, self).format(record)
+        return super().format(record)
 
 
 DEFAULT_LOGGING_CONFIG = {
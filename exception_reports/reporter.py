@@ -1,14 +1,19 @@
 import functools
 import json
 import logging
+import operator
+import os
 import re
+import reprlib
 import sys
+import tempfile
+import tokenize
 import types
+from collections import deque
 from contextlib import suppress
 from datetime import datetime, date, timezone
-from html import escape
 from pathlib import Path
-from pprint import pformat, saferepr
+from pprint import saferepr
 import platform
 
 import jinja2
@@ -18,13 +23,26 @@ from exception_reports.utils import force_text, gen_error_filename
 
 logger = logging.getLogger(__name__)
 
+# equivalent to html.escape(quote=True), applied in a single pass
+_HTML_ESCAPE_TABLE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"})
+
+# File coding may be specified. Match pattern from PEP-263
+# (http://www.python.org/dev/peps/pep-0263/)
+_CODING_RE = re.compile(br"coding[:=]\s*([-\w.]+)")
+
+_REPORT_TEMPLATE_NAME = "report_template.html"
+
+# interpreter details that don't change for the life of the process
+_SYS_EXECUTABLE = sys.executable
+_PY_VERSION_STR = "%d.%d.%d" % sys.version_info[0:3]
+
 
 @functools.lru_cache()
 def _report_template():
     """get the report template"""
     current_dir = Path(__file__).parent
 
-    with open(current_dir / "report_template.html", "r") as f:
+    with open(current_dir / _REPORT_TEMPLATE_NAME, "r") as f:
         template = f.read()
         template = re.sub(r"\s{2,}", " ", template)
         template = re.sub(r"\n", "", template)
@@ -32,12 +50,76 @@ def _report_template():
     return template
 
 
+def _load_template(name):
+    """jinja loader for the built-in report template"""
+    if name == _REPORT_TEMPLATE_NAME:
+        return _report_template()
+    return None
+
+
+class _BytecodeCache(jinja2.FileSystemBytecodeCache):
+    """
+    FileSystemBytecodeCache that treats any problem reading or writing the cache as a cache miss.
+
+    The cache is only an optimisation, a report must still render when it's unusable.
+    """
+
+    def load_bytecode(self, bucket):
+        try:
+            super().load_bytecode(bucket)
+        except Exception:
+            # e.g. a truncated cache file, the template gets compiled and the file rewritten
+            bucket.reset()
+
+    def dump_bytecode(self, bucket):
+        # write to a temporary file and move it into place so other processes never load a partial cache file
+        filename = self._get_cache_filename(bucket)
+        f = None
+        try:
+            with tempfile.NamedTemporaryFile(mode="wb", dir=os.path.dirname(filename), prefix=os.path.basename(filename), suffix=".tmp", delete=False) as f:
+                bucket.write_bytecode(f)
+            os.replace(f.name, filename)
+        except Exception:
+            if f is not None:
+                with suppress(OSError):
+                    os.remove(f.name)
+
+
+@functools.lru_cache()
+def _jinja_env():
+    """get the jinja environment used to render reports"""
+    # compiled templates are cached on disk so new processes don't have to re-parse the report template
+    try:
+        bytecode_cache = _BytecodeCache(pattern="exception_reports_%s.cache")
+    except (RuntimeError, OSError):
+        # jinja couldn't find or create a safe cache directory
+        bytecode_cache = None
+    return jinja2.Environment(loader=jinja2.FunctionLoader(_load_template), extensions=["jinja2.ext.autoescape"], bytecode_cache=bytecode_cache)
+
+
+@functools.lru_cache()
+def _compile_template(report_template):
+    """compile a custom report template, reusing the result for identical template sources"""
+    return _jinja_env().from_string(report_template)
+
+
+def _get_template(report_template=None):
+    """get the compiled report template, defaulting to the built-in one"""
+    if report_template:
+        return _compile_template(report_template)
+    return _jinja_env().get_template(_REPORT_TEMPLATE_NAME)
+
+
 def render_exception_html(exception_data, report_template=None):
     """Render exception_data as an html report"""
-    report_template = report_template or _report_template()
-    jinja_env = jinja2.Environment(loader=jinja2.BaseLoader(), extensions=["jinja2.ext.autoescape"])
     exception_data["repr"] = repr
-    return jinja_env.from_string(report_template).render(exception_data)
+    return _get_template(report_template).render(exception_data)
+
+
+def stream_exception_html(exception_data, fp, report_template=None):
+    """Render exception_data as an html report, writing it to the text file object fp as it's generated"""
+    exception_data["repr"] = repr
+    _get_template(report_template).stream(exception_data).dump(fp)
 
 
 def render_exception_json(exception_data):
@@ -56,44 +138,84 @@ def _json_serializer(obj):
     return saferepr(obj)
 
 
-def get_exception_data(exc_type=None, exc_value=None, tb=None, get_full_tb=False, max_var_length=4096 + 2048):
+class _VarRepr(reprlib.Repr):
+    """
+    Formats frame variables, bounding the output size while it is being built rather than after.
+
+    Only builtin containers, strings and ints are bounded during traversal. Any other object's __repr__
+    still runs in full and is cut to maxother afterwards, so a later "<trimmed N bytes string>" marker
+    reports the length after that cut, not the size of the object's full repr.
+
+    Unlike reprlib.Repr, errors raised by an object's __repr__ are not swallowed so they can be reported.
+    """
+
+    def repr_instance(self, x, level):
+        s = repr(x)
+        if len(s) > self.maxother:
+            i = max(0, (self.maxother - 3) // 2)
+            j = max(0, self.maxother - 3 - i)
+            s = f"{s[:i]}...{s[len(s) - j:]}"
+        return s
+
+
+@functools.lru_cache()
+def _var_repr(max_length):
+    """get a variable formatter whose output is bounded by max_length"""
+    var_repr = _VarRepr()
+    var_repr.maxlevel = 6
+    var_repr.maxtuple = var_repr.maxlist = var_repr.maxarray = var_repr.maxdict = 100
+    var_repr.maxset = var_repr.maxfrozenset = var_repr.maxdeque = 100
+    var_repr.maxstring = var_repr.maxlong = var_repr.maxother = max_length
+    return var_repr
+
+
+def _render_var(v, var_repr, max_var_length):
+    """Format a frame variable as text, trimming it to roughly max_var_length"""
+    head_var_length = int(max_var_length / 2)
+    tail_var_length = max_var_length - head_var_length
+
+    # Trim large strings before formatting them so only the parts we keep get copied.
+    # Escapes can make the repr of each part longer than the part itself, so cut it back to its budget.
+    if isinstance(v, (str, bytes)) and len(v) > max_var_length:
+        head = repr(v[0:head_var_length])[0:head_var_length]
+        tail = repr(v[-tail_var_length:])[-tail_var_length:]
+        return f"{head}... \n\n<trimmed {len(v)} bytes string>\n\n ...{tail}"
+
+    try:
+        v = var_repr.repr(v)
+    except Exception as e:
+        try:
+            v = saferepr(e)
+        except Exception:
+            v = "An error occurred rendering the exception of type: " + repr(e.__class__)
+    # Trim large blobs of data
+    if len(v) > max_var_length:
+        v = f"{v[0:head_var_length]}... \n\n<trimmed {len(v)} bytes string>\n\n ...{v[-tail_var_length:]}"
+    return v
+
+
+def get_exception_data(exc_type=None, exc_value=None, tb=None, get_full_tb=False, max_var_length=4096 + 2048, include_vars=True):
     """
     Return a dictionary containing exception information.
 
     if exc_type, exc_value, and tb are not provided they will be supplied by sys.exc_info()
 
     max_var_length: how long a variable's output can be before it's truncated
+    include_vars: whether to collect the local variables of each frame
 
     """
 
-    head_var_length = int(max_var_length / 2)
-    tail_var_length = max_var_length - head_var_length
-
     if not tb:
         exc_type, exc_value, tb = sys.exc_info()
 
-    frames = get_traceback_frames(exc_value=exc_value, tb=tb, get_full_tb=get_full_tb)
+    frames = get_traceback_frames(exc_value=exc_value, tb=tb, get_full_tb=get_full_tb, include_vars=include_vars)
 
-    for i, frame in enumerate(frames):
+    # leave room past max_var_length so long values still get the trimmed marker
+    render_var = functools.partial(_render_var, var_repr=_var_repr(max_var_length * 2), max_var_length=max_var_length)
+    escape_table = _HTML_ESCAPE_TABLE
+    for frame in frames:
         if "vars" in frame:
-            frame_vars = []
-            for k, v in frame["vars"]:
-                try:
-                    v = pformat(v)
-                except Exception as e:
-                    try:
-                        v = saferepr(e)
-                    except Exception:
-                        v = "An error occurred rendering the exception of type: " + repr(e.__class__)
-                # The force_escape filter assume unicode, make sure that works
-                if isinstance(v, bytes):
-                    v = v.decode("utf-8", "replace")  # don't choke on non-utf-8 input
-                # Trim large blobs of data
-                if len(v) > max_var_length:
-                    v = f"{v[0:head_var_length]}... \n\n<trimmed {len(v)} bytes string>\n\n ...{v[-tail_var_length:]}"
-                frame_vars.append((k, escape(v)))
-            frame["vars"] = frame_vars
-        frames[i] = frame
+            frame["vars"] = [(k, render_var(v).translate(escape_table)) for k, v in frame["vars"]]
 
     unicode_hint = ""
     if exc_type and issubclass(exc_type, UnicodeError):
@@ -110,10 +232,10 @@ def get_exception_data(exc_type=None, exc_value=None, tb=None, get_full_tb=False
     c = {
         "unicode_hint": unicode_hint,
         "frames": frames,
-        "sys_executable": sys.executable,
-        "sys_version_info": "%d.%d.%d" % sys.version_info[0:3],
+        "sys_executable": _SYS_EXECUTABLE,
+        "sys_version_info": _PY_VERSION_STR,
         "server_time": datetime.now(timezone.utc),
-        "sys_path": sys.path,
+        "sys_path": list(sys.path),
         "platform": platform.uname()._asdict(),
     }
     # Check whether exception info is available
@@ -127,44 +249,86 @@ def get_exception_data(exc_type=None, exc_value=None, tb=None, get_full_tb=False
     return c
 
 
-def get_lines_from_file(filename, lineno, context_lines, loader=None, module_name=None):
+def _decode_source(source):
+    """Decode source lines returned as bytes, using the PEP-263 encoding declaration if there is one"""
+    encoding = "ascii"
+    for line in source[:2]:
+        match = _CODING_RE.search(line)
+        if match:
+            encoding = match.group(1).decode("ascii")
+            break
+    try:
+        return [str(sline, encoding, "replace") for sline in source]
+    except LookupError:
+        return [str(sline, "ascii", "replace") for sline in source]
+
+
+@functools.lru_cache(maxsize=512)
+def _read_source_file(filename, mtime):
     """
-    Returns context_lines before and after lineno from file.
-    Returns (pre_context_lineno, pre_context, context_line, post_context).
+    Read a source file, decoding it the same way the interpreter would.
+
+    Results are cached across frames and reports. mtime is part of the cache key so edited files are re-read.
+    """
+    with open(filename, "rb") as fp:
+        encoding, _ = tokenize.detect_encoding(fp.readline)
+        fp.seek(0)
+        return tuple(fp.read().decode(encoding, "replace").splitlines())
+
+
+def _get_source(filename, loader=None, module_name=None):
+    """
+    Returns the decoded source lines for filename, or None if the source can't be loaded.
+
+    Files on disk are read through the cached _read_source_file; the loader is only asked for
+    sources that aren't on disk (zipimport, <string>, etc.).
     """
-    source = None
+    with suppress(OSError, SyntaxError):
+        return _read_source_file(filename, os.stat(filename).st_mtime)
+
     if loader is not None and hasattr(loader, "get_source"):
+        source = None
         with suppress(ImportError):
             source = loader.get_source(module_name)
         if source is not None:
             source = source.splitlines()
-    if source is None:
-        with suppress(OSError, IOError):
-            with open(filename, "rb") as fp:
-                source = fp.read().splitlines()
+            # the loader may not have applied tokenize.detect_encoding to decode the source
+            if source and isinstance(source[0], bytes):
+                source = _decode_source(source)
+            return source
+
+    return None
+
+
+def get_lines_from_file(filename, lineno, context_lines, loader=None, module_name=None, source_cache=None):
+    """
+    Returns context_lines before and after lineno from file.
+    Returns (pre_context_lineno, pre_context, context_line, post_context).
+
+    source_cache: optional dict used to share decoded source between calls for the same file
+    """
+    if source_cache is None:
+        source = _get_source(filename, loader, module_name)
+    else:
+        cache_key = (filename, module_name)
+        if cache_key not in source_cache:
+            source_cache[cache_key] = _get_source(filename, loader, module_name)
+        source = source_cache[cache_key]
+
     if source is None:
         return None, [], None, []
     try:
-        # If we just read the source from a file, or if the loader did not
-        # apply tokenize.detect_encoding to decode the source into a Unicode
-        # string, then we should do that ourselves.
-        if isinstance(source[0], bytes):
-            encoding = "ascii"
-            for line in source[:2]:
-                # File coding may be specified. Match pattern from PEP-263
-                # (http://www.python.org/dev/peps/pep-0263/)
-                match = re.search(br"coding[:=]\s*([-\w.]+)", line)
-                if match:
-                    encoding = match.group(1).decode("ascii")
-                    break
-            source = [str(sline, encoding, "replace") for sline in source]
+        line_count = len(source)
+        if not 0 <= lineno < line_count:
+            raise IndexError(f"line {lineno + 1} is outside the loaded source")
 
         lower_bound = max(0, lineno - context_lines)
-        upper_bound = lineno + context_lines
+        upper_bound = min(line_count, lineno + context_lines + 1)
 
-        pre_context = source[lower_bound:lineno]
+        # source may be the cached tuple, hand out lists so callers always get the same type
+        pre_context = list(source[lower_bound:lineno])
         context_line = source[lineno]
-        post_context = source[lineno + 1 : upper_bound]
+        post_context = list(source[lineno + 1 : upper_bound])
 
         return lower_bound, pre_context, context_line, post_context
     except Exception as e:
@@ -175,68 +339,90 @@ def get_lines_from_file(filename, lineno, context_lines, loader=None, module_nam
         return lineno, [], context_line, []
 
 
-def get_traceback_frames(exc_value=None, tb=None, get_full_tb=True):
+# the frame attributes get_traceback_frames reads, fetched in a single call
+_frame_fields = operator.attrgetter("f_locals", "f_globals", "f_code.co_filename", "f_code.co_name")
+
+# frames from these modules are rendered as framework code rather than user code
+_FRAMEWORK_MODULE_PREFIXES = ("django.",)
+
+
+@functools.lru_cache(maxsize=256)
+def _frame_type(module_name):
+    """classify a frame by the name of the module it's in"""
+    return "django" if module_name.startswith(_FRAMEWORK_MODULE_PREFIXES) else "user"
+
+
+def get_traceback_frames(exc_value=None, tb=None, get_full_tb=True, include_vars=True):
     def explicit_or_implicit_cause(exc_value):
         explicit = getattr(exc_value, "__cause__", None)
         implicit = getattr(exc_value, "__context__", None)
         return explicit or implicit
 
-    # Get the exception and all its causes
-    exceptions = []
-    while exc_value:
-        exceptions.append(exc_value)
+    def exception_fields(exc_value):
+        """frame fields that only change when we move on to another exception"""
+        return explicit_or_implicit_cause(exc_value), getattr(exc_value, "__cause__", True), getattr(exc_value, "is_full_stack_trace", False)
+
+    # Get the exception and all its causes, oldest cause first
+    exceptions = deque()
+    seen = set()
+    while exc_value and id(exc_value) not in seen:
+        # a cycle in the cause chain would otherwise loop forever
+        seen.add(id(exc_value))
+        exceptions.appendleft(exc_value)
         exc_value = explicit_or_implicit_cause(exc_value)
 
     frames = []
+    source_cache = {}
     # No exceptions were supplied
     if not exceptions:
         return frames
 
     # In case there's just one exception, take the traceback from self.tb
-    exc_value = exceptions.pop()
+    exc_value = exceptions.popleft()
     tb = tb if not exceptions else exc_value.__traceback__
+    exc_cause, exc_cause_explicit, is_full_stack_trace = exception_fields(exc_value)
     added_full_tb = False
     while tb is not None:
         # Support for __traceback_hide__ which is used by a few libraries
         # to hide internal frames.
-        if tb.tb_frame.f_locals.get("__traceback_hide__"):
+        f_locals, f_globals, filename, function = _frame_fields(tb.tb_frame)
+        if f_locals.get("__traceback_hide__"):
             tb = tb.tb_next
             continue
-        filename = tb.tb_frame.f_code.co_filename
-        function = tb.tb_frame.f_code.co_name
         lineno = tb.tb_lineno - 1
-        loader = tb.tb_frame.f_globals.get("__loader__")
-        module_name = tb.tb_frame.f_globals.get("__name__") or ""
-        pre_context_lineno, pre_context, context_line, post_context = get_lines_from_file(filename, lineno, 7, loader, module_name)
+        loader = f_globals.get("__loader__")
+        module_name = f_globals.get("__name__") or ""
+        pre_context_lineno, pre_context, context_line, post_context = get_lines_from_file(filename, lineno, 7, loader, module_name, source_cache)
         if pre_context_lineno is None:
             pre_context_lineno = lineno
             pre_context = []
             context_line = "<source code not available>"
             post_context = []
-        frames.append(
-            {
-                "exc_cause": explicit_or_implicit_cause(exc_value),
-                "exc_cause_explicit": getattr(exc_value, "__cause__", True),
-                "is_full_stack_trace": getattr(exc_value, "is_full_stack_trace", False),
-                "tb": tb,
-                "type": "django" if module_name.startswith("django.") else "user",
-                "filename": filename,
-                "function": function,
-                "lineno": lineno + 1,
-                "vars": list(tb.tb_frame.f_locals.items()),
-                "id": id(tb),
-                "pre_context": pre_context,
-                "context_line": context_line,
-                "post_context": post_context,
-                "pre_context_lineno": pre_context_lineno + 1,
-            }
-        )
+        frame = {
+            "exc_cause": exc_cause,
+            "exc_cause_explicit": exc_cause_explicit,
+            "is_full_stack_trace": is_full_stack_trace,
+            "tb": tb,
+            "type": _frame_type(module_name),
+            "filename": filename,
+            "function": function,
+            "lineno": lineno + 1,
+            "id": id(tb),
+            "pre_context": pre_context,
+            "context_line": context_line,
+            "post_context": post_context,
+            "pre_context_lineno": pre_context_lineno + 1,
+        }
+        if include_vars:
+            frame["vars"] = list(f_locals.items())
+        frames.append(frame)
 
         # If the traceback for current exception is consumed, try the
         # other exception.
         if not tb.tb_next and exceptions:
-            exc_value = exceptions.pop()
+            exc_value = exceptions.popleft()
             tb = exc_value.__traceback__
+            exc_cause, exc_cause_explicit, is_full_stack_trace = exception_fields(exc_value)
         else:
             tb = tb.tb_next
 
@@ -245,29 +431,32 @@ def get_traceback_frames(exc_value=None, tb=None, get_full_tb=True):
             exc_value.is_full_stack_trace = True
             exc_value.__cause__ = Exception("Full Stack Trace")
             tb = get_logger_traceback()
+            exc_cause, exc_cause_explicit, is_full_stack_trace = exception_fields(exc_value)
             added_full_tb = True
 
     return frames
 
 
-def create_exception_report(exc_type, exc_value, tb, output_format, storage_backend, data_processor=None, get_full_tb=False):
+def create_exception_report(exc_type, exc_value, tb, output_format, storage_backend, data_processor=None, get_full_tb=False, include_vars=True):
     """
     Create an exception report and return its location
     """
-    exception_data = get_exception_data(exc_type, exc_value, tb, get_full_tb=get_full_tb)
+    exception_data = get_exception_data(exc_type, exc_value, tb, get_full_tb=get_full_tb, include_vars=include_vars)
     if data_processor:
         exception_data = data_processor(exception_data)
 
-    if output_format == "html":
-        text = render_exception_html(exception_data)
-    elif output_format == "json":
-        text = render_exception_json(exception_data)
-    else:
+    if output_format not in ("html", "json"):
         raise TypeError("Exception report format not correctly specified")
 
     filename = gen_error_filename(extension=output_format)
 
-    report_location = storage_backend.write(filename, text)
+    if output_format == "html" and hasattr(storage_backend, "write_stream"):
+        report_location = storage_backend.write_stream(filename, functools.partial(stream_exception_html, exception_data))
+    elif output_format == "html":
+        # storage backends only have to implement write()
+        report_location = storage_backend.write(filename, render_exception_html(exception_data))
+    else:
+        report_location = storage_backend.write(filename, render_exception_json(exception_data))
 
     return report_location
 
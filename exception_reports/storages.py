@@ -3,8 +3,10 @@ import logging
 import os
 import os.path
 from base64 import b64encode
+from contextlib import suppress
 from datetime import datetime
 from http.client import HTTPSConnection
+from io import StringIO
 from wsgiref.handlers import format_date_time
 
 logger = logging.getLogger(__name__)
@@ -18,19 +20,35 @@ class ErrorStorage:
     def write(self, filename, data):
         pass
 
+    def write_stream(self, filename, render):
+        """
+        Write a report generated by render, a callable that writes the report's text to the file object it's given.
+
+        Storages that can write incrementally should override this; by default the report is collected and the
+        same str that would otherwise have been rendered is passed to write.
+        """
+        with StringIO() as f:
+            render(f)
+            return self.write(filename, f.getvalue())
+
 
 class LocalErrorStorage(ErrorStorage):
     def __init__(self, output_path="/tmp/python-error-reports/", prefix=""):
         self.output_path = output_path
         self.prefix = prefix
 
-    def write(self, filename, data):
+    def _prepare_filepath(self, filename):
         output_path = str(self.output_path)
         filepath = os.path.abspath(os.path.join(output_path, self.prefix + filename))
 
         # make directory if it doesn't exist
         os.makedirs(os.path.dirname(filepath), exist_ok=True)
 
+        return filepath
+
+    def write(self, filename, data):
+        filepath = self._prepare_filepath(filename)
+
         if isinstance(data, str):
             data = data.encode("utf8", "surrogateescape")
 
@@ -39,6 +57,21 @@ class LocalErrorStorage(ErrorStorage):
 
         return filepath
 
+    def write_stream(self, filename, render):
+        filepath = self._prepare_filepath(filename)
+
+        try:
+            # encoded the same way as write() so both produce identical files
+            with open(filepath, "w", encoding="utf8", errors="surrogateescape", newline="") as f:
+                render(f)
+        except Exception:
+            # don't leave a truncated report behind if rendering fails part way through
+            with suppress(OSError):
+                os.remove(filepath)
+            raise
+
+        return filepath
+
 
 class S3ErrorStorage(ErrorStorage):
     def __init__(self, bucket, access_key: str = None, secret_key: str = None, region: str = None, prefix: str = ""):
@@ -1,5 +1,5 @@
 import datetime
-import uuid
+import secrets
 from decimal import Decimal
 
 _PROTECTED_TYPES = (type(None), int, float, Decimal, datetime.datetime, datetime.date, datetime.time)
@@ -37,4 +37,4 @@ def force_text(s, encoding="utf-8", strings_only=False, errors="strict"):
 
 
 def gen_error_filename(extension):
-    return f"{datetime.datetime.now(datetime.timezone.utc)}_{uuid.uuid4().hex}.{extension}".replace(" ", "_").replace(":", "-")
+    return f"{datetime.datetime.now(datetime.timezone.utc)}_{secrets.token_hex(16)}.{extension}".replace(" ", "_").replace(":", "-")
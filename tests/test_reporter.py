@@ -1,8 +1,23 @@
 import json
 import os
-
-from exception_reports.reporter import render_exception_html, render_exception_json, get_exception_data, get_lines_from_file
-from exception_reports.storages import LocalErrorStorage
+import tempfile
+from io import StringIO
+
+import jinja2.bccache
+import pytest
+
+from exception_reports.reporter import (
+    render_exception_html,
+    render_exception_json,
+    stream_exception_html,
+    create_exception_report,
+    get_exception_data,
+    get_lines_from_file,
+    get_traceback_frames,
+    _read_source_file,
+    _jinja_env,
+)
+from exception_reports.storages import ErrorStorage, LocalErrorStorage
 
 
 def test_exception_report_data():
@@ -35,6 +50,22 @@ def test_exception_report_data():
     assert local_vars["green"] == "93"
 
 
+def test_exception_report_data_without_vars():
+    def a(foo):
+        green = 93  # noqa
+        raise Exception("yolo!")
+
+    try:
+        a("hi")
+    except Exception:
+        exception_data = get_exception_data(get_full_tb=False, include_vars=False)
+
+    frames = exception_data["frames"]
+    assert frames[-1]["function"] == "a"
+    assert all("vars" not in frame for frame in frames)
+    render_exception_html(exception_data)
+
+
 def test_report_from_json():
     """If we make the html report from the json data is it identical?"""
 
@@ -110,6 +141,22 @@ def test_report_from_json():
     assert html_1 == html_2
 
 
+def test_cyclic_exception_causes():
+    try:
+        raise KeyError("first")
+    except KeyError as e:
+        first = e
+    try:
+        raise ValueError("second")
+    except ValueError as e:
+        second = e
+    first.__cause__ = second
+    second.__cause__ = first
+
+    frames = get_traceback_frames(exc_value=second, tb=second.__traceback__, get_full_tb=False)
+    assert len(frames) == 2
+
+
 def test_rendering_exception_during_exception():
     class MyException(Exception):
         def __repr__(self):
@@ -151,6 +198,28 @@ def test_rendering_long_string():
     assert "&lt;trimmed" in local_vars["big_str"]
 
 
+def test_rendering_huge_string():
+    max_var_length = 4096 + 2048
+    huge_str = "a" * 10_000_000  # noqa
+    # each control character becomes a four character escape when formatted
+    escaped_bytes = b"\x00" * 20000  # noqa
+    escaped_str = "\x00" * 20000  # noqa
+
+    try:
+        raise Exception("on purpose")
+    except Exception:
+        exception_data = get_exception_data(get_full_tb=False, max_var_length=max_var_length)
+
+    local_vars = dict(exception_data["frames"][-1]["vars"])
+
+    assert "&lt;trimmed 10000000 bytes string&gt;" in local_vars["huge_str"]
+    assert "&lt;trimmed 20000 bytes string&gt;" in local_vars["escaped_bytes"]
+    assert "&lt;trimmed 20000 bytes string&gt;" in local_vars["escaped_str"]
+    # allow for the trimmed marker and the html-escaped quotes
+    for name in ("huge_str", "escaped_bytes", "escaped_str"):
+        assert len(local_vars[name]) < max_var_length + 100
+
+
 def test_rendering_unicode_error(tmpdir):
     some_bytes = b"asdfljsadf\x23\x93\x01"
     try:
@@ -177,6 +246,123 @@ def test_saving_unicode_error(tmpdir):
     storage_backend.write("bug_report.html", html)
 
 
+def test_streamed_report_matches_rendered(tmpdir):
+    try:
+        raise Exception("on purpose")
+    except Exception:
+        exception_data = get_exception_data(get_full_tb=False)
+
+    html = render_exception_html(exception_data)
+    with StringIO() as f:
+        stream_exception_html(exception_data, f)
+        assert f.getvalue() == html
+
+    storage_backend = LocalErrorStorage(output_path=str(tmpdir))
+    filepath = storage_backend.write_stream("bug_report.html", lambda f: stream_exception_html(exception_data, f))
+    with open(filepath, "rb") as f:
+        assert f.read() == html.encode("utf8")
+
+
+def test_create_html_report(tmpdir):
+    try:
+        raise Exception("on purpose")
+    except Exception as e:
+        report_location = create_exception_report(type(e), e, e.__traceback__, "html", LocalErrorStorage(output_path=str(tmpdir)))
+
+    assert [str(p) for p in tmpdir.listdir()] == [report_location]
+    with open(report_location, "r", encoding="utf8") as f:
+        assert "on purpose" in f.read()
+
+
+def test_failed_html_report_leaves_no_file(tmpdir):
+    class Unrenderable:
+        def __str__(self):
+            raise RuntimeError("can't render this")
+
+    def break_rendering(exception_data):
+        exception_data["exception_type"] = Unrenderable()
+        return exception_data
+
+    try:
+        raise Exception("on purpose")
+    except Exception as e:
+        with pytest.raises(RuntimeError):
+            create_exception_report(type(e), e, e.__traceback__, "html", LocalErrorStorage(output_path=str(tmpdir)), data_processor=break_rendering)
+
+    assert not tmpdir.listdir()
+
+
+def test_html_report_storage_backends_receive_text():
+    """Storages that only implement write() are given the rendered report as a str"""
+
+    class DuckTypedStorage:
+        def write(self, filename, data):
+            self.data = data
+            return filename
+
+    class SubclassedStorage(ErrorStorage):
+        def write(self, filename, data):
+            self.data = data
+            return filename
+
+    for storage_backend in (DuckTypedStorage(), SubclassedStorage()):
+        try:
+            raise Exception("on purpose")
+        except Exception as e:
+            create_exception_report(type(e), e, e.__traceback__, "html", storage_backend)
+
+        assert isinstance(storage_backend.data, str)
+        assert "on purpose" in storage_backend.data
+
+
+def _render_report_with_fresh_jinja_env():
+    """render a report using a jinja environment (and bytecode cache) created from the current temp dir"""
+    try:
+        raise Exception("on purpose")
+    except Exception:
+        exception_data = get_exception_data(get_full_tb=False)
+
+    _jinja_env.cache_clear()
+    try:
+        return render_exception_html(exception_data)
+    finally:
+        _jinja_env.cache_clear()
+
+
+def test_report_with_unusable_bytecode_cache_dir(monkeypatch):
+    monkeypatch.setattr(tempfile, "tempdir", "/nonexistent-dir")
+
+    assert "on purpose" in _render_report_with_fresh_jinja_env()
+
+
+def test_report_with_corrupt_bytecode_cache(monkeypatch, tmpdir):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmpdir))
+    _render_report_with_fresh_jinja_env()
+
+    cache_files = list(tmpdir.visit("exception_reports_*.cache"))
+    assert len(cache_files) == 1
+    cache_file = cache_files[0]
+    intact_size = cache_file.size()
+    # cut the file off part way through the pickled checksum that follows the magic header
+    with open(str(cache_file), "r+b") as f:
+        f.truncate(len(jinja2.bccache.bc_magic) + 2)
+
+    assert "on purpose" in _render_report_with_fresh_jinja_env()
+    # the truncated file is replaced with a good one
+    assert cache_file.size() == intact_size
+
+
+def test_report_when_bytecode_cache_write_fails(monkeypatch, tmpdir):
+    def full_disk(bucket, f):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(tempfile, "tempdir", str(tmpdir))
+    monkeypatch.setattr("jinja2.bccache.Bucket.write_bytecode", full_disk)
+
+    assert "on purpose" in _render_report_with_fresh_jinja_env()
+    assert not list(tmpdir.visit("exception_reports_*"))
+
+
 def test_exception_data_json():
     try:
         raise Exception("on purpose")
@@ -185,7 +371,41 @@ def test_exception_data_json():
     render_exception_json(exception_data)
 
 
+def test_source_cached_across_reports():
+    def report_json_error():
+        try:
+            json.loads("{")
+        except ValueError:
+            return get_exception_data(get_full_tb=False)
+
+    _read_source_file.cache_clear()
+
+    report_json_error()
+    first_report = _read_source_file.cache_info()
+    exception_data = report_json_error()
+    second_report = _read_source_file.cache_info()
+
+    # every frame's file, including the json module's, is served from the cache the second time
+    filenames = {frame["filename"] for frame in exception_data["frames"]}
+    assert any(filename.endswith(os.path.join("json", "decoder.py")) for filename in filenames)
+    assert second_report.misses == first_report.misses
+    assert second_report.hits - first_report.hits == len(filenames)
+
+
 def test_bad_sourcefile():
     empty_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), "__init__.py")
     lower_bound, pre_context, context_line, post_context = get_lines_from_file(empty_file, 999, 4)
     assert "There was an error displaying the source" in context_line
+
+
+def test_sourcefile_context_bounds():
+    this_file = os.path.realpath(__file__)
+    lower_bound, pre_context, context_line, post_context = get_lines_from_file(this_file, 0, 3)
+    assert lower_bound == 0
+    assert pre_context == []
+    assert context_line == "import json"
+    assert isinstance(post_context, list)
+    assert len(post_context) == 3
+
+    lower_bound, pre_context, context_line, post_context = get_lines_from_file(this_file, -1, 3)
+    assert "There was an error displaying the source" in context_line